@@ -3,4 +3,13 @@ API_KEY = "your_api_key_here"
 DB_FILE = "/home/pi/orders.db"
 SERIAL_PORT = "/dev/ttyUSB0"
 OPEN_ALL_CODE = "your_keypad_code" # Code to open all doors at the same time
-ALL_DOORS = [1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20]
\ No newline at end of file
+ALL_DOORS = [1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20]
+# Optional: route doors to several Arduinos. Maps door -> (serial port, relay number on that Arduino).
+# Doors not listed here are opened on SERIAL_PORT using the door number as relay number.
+# Example: doors 33-40 on a second cabinet wired to relays 1-8 of another Arduino:
+# DOOR_ROUTES = {door: ("/dev/ttyUSB1", door - 32) for door in range(33, 41)}
+DOOR_ROUTES = {}
+# Structured event log (JSON lines, rotated at 5 MB), one <service>.events.log per service in EVENT_LOG_DIR.
+# Level is one of debug, info, warning, error.
+EVENT_LOG_DIR = "/home/pi"
+EVENT_LOG_LEVEL = "info"
@@ -0,0 +1,132 @@
+import time
+import serial
+import threading
+from datetime import datetime
+import constants
+from constants import SERIAL_PORT
+from event_log import log_event, event_context, current_context
+
+# ------------------------------------------------------------------------------
+# Door Routing
+# ------------------------------------------------------------------------------
+# DOOR_ROUTES in constants.py maps a door number to (serial_port, relay_number).
+# Doors that are not listed are sent to SERIAL_PORT with the door number as relay
+# number, which is how a machine with a single Arduino has always worked.
+DOOR_ROUTES = {str(door).strip(): route for door, route in getattr(constants, "DOOR_ROUTES", {}).items()}
+
+RELAY_STAGGER_MS = 500   # Delay between relays, also across controllers (shared lock power supply)
+RELAY_DURATION_MS = 1000  # How long each relay is held open
+ACK_RESPONSE = "Relays queued for activation"  # What the firmware prints after an OPEN command
+MAX_RELAY = 32            # The firmware maps relays 1-32 and silently skips anything else
+
+# Per-controller health, keyed by serial port
+_health = {}
+_health_lock = threading.Lock()
+
+def route_door(door):
+    """
+    Returns (serial_port, relay_number) for a door, or (serial_port, None) if the door
+    does not map to a relay the firmware can drive.
+    """
+    port, relay = DOOR_ROUTES.get(str(door).strip(), (SERIAL_PORT, door))
+    try:
+        relay = int(str(relay).strip())
+    except ValueError:
+        return port, None
+    if not 1 <= relay <= MAX_RELAY:
+        return port, None
+    return port, relay
+
+def group_doors_by_controller(doors):
+    """
+    Splits doors into {serial_port: [relay_number, ...]}, keeping the original order.
+    Returns (groups, invalid_doors); doors without a valid relay are left out of groups.
+    """
+    groups = {}
+    invalid = []
+    for door in doors:
+        port, relay = route_door(door)
+        if relay is None:
+            invalid.append(door)
+        else:
+            groups.setdefault(port, []).append(relay)
+    return groups, invalid
+
+def _record_health(port, ok, error=None):
+    """Tracks consecutive failures per controller and logs when a controller goes down or recovers."""
+    now = datetime.now().isoformat(' ', timespec='seconds')
+    with _health_lock:
+        state = _health.setdefault(port, {"last_ok": None, "last_error": None, "failures": 0})
+        previous_failures = state["failures"]
+        if ok:
+            state["last_ok"] = now
+            state["failures"] = 0
+        else:
+            state["last_error"] = f"{now}: {error}"
+            state["failures"] += 1
+        snapshot = dict(state)
+    if not ok:
+        log_event("controller_unhealthy", level="error", port=port, **snapshot)
+    elif previous_failures:
+        log_event("controller_recovered", port=port, failed_attempts=previous_failures)
+
+def send_open_command(port, relays, start_delay=0):
+    """
+    Sends one OPEN command for the given relays to the Arduino on port.
+    Relays are staggered by RELAY_STAGGER_MS, starting after start_delay ms.
+    """
+    started = time.time()
+    try:
+        ser = serial.Serial(port, 9600, timeout=1)
+        time.sleep(2)  # The Arduino resets when the port is opened
+        relay_commands = [f"{relay}:{start_delay + i*RELAY_STAGGER_MS}:{RELAY_DURATION_MS}" for i, relay in enumerate(relays)]
+        command = f"OPEN:{','.join(relay_commands)}\n"
+        ser.write(command.encode())
+        response = ser.readline().decode(errors='replace').strip()
+        ser.close()
+        if response != ACK_RESPONSE:
+            raise IOError(f"unexpected reply {response!r}")
+        log_event("relays_opened", port=port, relays=relays, command=command.strip(), response=response,
+                  duration_ms=round((time.time() - started) * 1000))
+        _record_health(port, True)
+        return True
+    except Exception as e:
+        log_event("relays_open_failed", level="error", port=port, relays=relays, error=str(e),
+                  duration_ms=round((time.time() - started) * 1000))
+        _record_health(port, False, e)
+        return False
+
+def open_doors(doors, start_delay=0):
+    """
+    Opens doors across all controllers they are routed to. Each controller gets a
+    single command, and controllers are driven in parallel so adding cabinets does
+    not add latency. The start delay of each controller continues the stagger of the
+    previous one, so relays still fire RELAY_STAGGER_MS apart in case the cabinets
+    share a power supply. Returns True if every door was valid and every controller
+    accepted its command.
+    """
+    groups, invalid = group_doors_by_controller(doors)
+    if invalid:
+        log_event("doors_unroutable", level="error", doors=invalid, max_relay=MAX_RELAY)
+    if not groups:
+        return not invalid
+    if len(groups) == 1:
+        port, relays = next(iter(groups.items()))
+        return send_open_command(port, relays, start_delay) and not invalid
+
+    results = {}
+    fields = current_context()
+    def worker(port, relays, delay):
+        with event_context(**fields):
+            results[port] = send_open_command(port, relays, delay)
+
+    threads = []
+    delay = start_delay
+    for port, relays in groups.items():
+        threads.append(threading.Thread(target=worker, args=(port, relays, delay), daemon=True))
+        delay += len(relays) * RELAY_STAGGER_MS
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return all(results.get(port, False) for port in groups) and not invalid
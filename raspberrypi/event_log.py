@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import uuid
+import atexit
+import threading
+import collections
+from contextlib import contextmanager
+from datetime import datetime
+import constants
+
+# ------------------------------------------------------------------------------
+# Structured Event Log
+# ------------------------------------------------------------------------------
+# Events are appended to an in-memory ring buffer and written as JSON lines by a
+# background thread, so the keypad and door paths never wait on disk or journald.
+# Each service writes its own file (e.g. order_service.events.log), so no two
+# processes ever append to or rotate the same file.
+# Query with e.g.: grep '"order_id": 1234' /home/pi/order_service.events.log
+EVENT_LOG_DIR = getattr(constants, "EVENT_LOG_DIR", "/home/pi")
+SERVICE_NAME = os.path.splitext(os.path.basename(sys.argv[0] or ""))[0] or "python"
+EVENT_LOG_FILE = os.path.join(EVENT_LOG_DIR, f"{SERVICE_NAME}.events.log")
+EVENT_LOG_LEVEL = getattr(constants, "EVENT_LOG_LEVEL", "info")
+EVENT_LOG_ECHO = getattr(constants, "EVENT_LOG_ECHO", True)  # Also write events to stdout (journald)
+EVENT_LOG_MAX_BYTES = 5 * 1024 * 1024  # Rotate when the log file grows past this size
+EVENT_LOG_BACKUPS = 3                  # Number of rotated files to keep (.events.log.1 ... .3)
+FLUSH_INTERVAL = 1.0                   # Seconds between batched writes
+BUFFER_SIZE = 10000                    # Oldest events are dropped if the writer falls behind
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+_buffer = collections.deque(maxlen=BUFFER_SIZE)
+_flush_now = threading.Event()
+_context = threading.local()
+_writer_lock = threading.Lock()
+_write_lock = threading.Lock()
+_writer = None
+_dropped = 0
+
+def new_correlation_id():
+    """Returns a short random id used to tie together the events of one keypad session or request."""
+    return uuid.uuid4().hex[:8]
+
+def mask_code(code):
+    """Masks a keypad code for logging, keeping only its first character and length."""
+    code = str(code or "").strip()
+    return code[:1] + "*" * (len(code) - 1)
+
+def current_context():
+    """Returns the fields bound to the current thread with event_context()."""
+    return dict(getattr(_context, "fields", {}))
+
+@contextmanager
+def event_context(**fields):
+    """Adds fields (e.g. session or order_id) to every event logged by this thread inside the block."""
+    previous = getattr(_context, "fields", {})
+    _context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+def log_event(event, level="info", **fields):
+    """
+    Queues a structured event. This only appends to the in-memory buffer; the
+    background writer takes care of serialization and file I/O.
+    """
+    global _dropped
+    if LEVELS.get(level, 20) < LEVELS.get(EVENT_LOG_LEVEL, 20):
+        return
+    _ensure_writer()
+    record = {"ts": datetime.now().isoformat(timespec='milliseconds'), "level": level, "event": event}
+    record.update(getattr(_context, "fields", {}))
+    record.update(fields)
+    if len(_buffer) == BUFFER_SIZE:
+        _dropped += 1
+    _buffer.append(record)
+    if LEVELS.get(level, 20) >= LEVELS["error"]:
+        _flush_now.set()
+
+def _ensure_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, daemon=True)
+            _writer.start()
+            atexit.register(flush)
+
+def _writer_loop():
+    while True:
+        _flush_now.wait(FLUSH_INTERVAL)
+        _flush_now.clear()
+        flush()
+
+def _rotate():
+    for i in range(EVENT_LOG_BACKUPS - 1, 0, -1):
+        src = f"{EVENT_LOG_FILE}.{i}"
+        if os.path.exists(src):
+            os.replace(src, f"{EVENT_LOG_FILE}.{i + 1}")
+    os.replace(EVENT_LOG_FILE, f"{EVENT_LOG_FILE}.1")
+
+def flush():
+    """Writes all buffered events to the log file (and stdout if enabled)."""
+    global _dropped
+    with _write_lock:
+        records = []
+        while _buffer:
+            records.append(_buffer.popleft())
+        if _dropped:
+            records.append({"ts": datetime.now().isoformat(timespec='milliseconds'), "level": "warning",
+                            "event": "event_log_dropped", "count": _dropped})
+            _dropped = 0
+        if not records:
+            return
+        lines = "".join(json.dumps(r, default=str, ensure_ascii=False) + "\n" for r in records)
+        if EVENT_LOG_ECHO:
+            sys.stdout.write(lines)
+            sys.stdout.flush()
+        try:
+            if os.path.exists(EVENT_LOG_FILE) and os.path.getsize(EVENT_LOG_FILE) >= EVENT_LOG_MAX_BYTES:
+                _rotate()
+            with open(EVENT_LOG_FILE, "a", encoding="utf-8") as f:
+                f.write(lines)
+        except OSError as e:
+            sys.stderr.write(f"Error writing event log {EVENT_LOG_FILE}: {e}\n")
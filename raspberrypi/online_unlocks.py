@@ -1,27 +1,19 @@
 import time
 import requests
-import serial
-from constants import API_URL, API_KEY, SERIAL_PORT
+from constants import API_URL, API_KEY
+from door_controllers import open_doors
+from event_log import log_event, event_context
+
+MAX_OPEN_ATTEMPTS = 3  # Give up on a request after this many failed opens (the relay may have fired anyway)
+
+# Failed open attempts per request id
+_open_attempts = {}
 
 def open_door(door_number):
     """
-    Sends a command via the serial port to open a specific door.
-    Adjust the command format to match your Arduino/relay requirements.
+    Opens a specific door on whichever controller it is routed to (see door_controllers.py).
     """
-    try:
-        ser = serial.Serial(SERIAL_PORT, 9600, timeout=1)
-        time.sleep(2)  # Give time for the connection to initialize
-        # Example command format; adjust as needed:
-        command = f"OPEN:{door_number}:500:1000\n"
-        ser.write(command.encode())
-        # Optionally, wait for a response:
-        response = ser.readline().decode().strip()
-        print(f"Serial response: {response}")
-        ser.close()
-        return True
-    except Exception as e:
-        print(f"Error opening door {door_number}: {e}")
-        return False
+    return open_doors([door_number], start_delay=500)
 
 def mark_request_executed(request_id):
     """
@@ -31,11 +23,11 @@ def mark_request_executed(request_id):
     try:
         r = requests.post(API_URL + "mark_request_executed.php", data=payload)
         if r.status_code == 200:
-            print(f"Request {request_id} marked as executed.")
+            log_event("request_marked_executed", request_id=request_id)
         else:
-            print(f"Error marking request {request_id} executed: {r.text}")
+            log_event("request_mark_failed", level="warning", request_id=request_id, status=r.status_code, response=r.text)
     except Exception as e:
-        print(f"Exception marking request {request_id} executed: {e}")
+        log_event("request_mark_failed", level="warning", request_id=request_id, error=str(e))
 
 def poll_door_requests():
     """
@@ -46,16 +38,31 @@ def poll_door_requests():
             response = requests.get(API_URL + "get_door_requests.php", params={"api_key": API_KEY})
             if response.status_code == 200:
                 requests_data = response.json()
+                # Forget attempts for requests the website no longer returns
+                pending_ids = {req.get('id') for req in requests_data}
+                for request_id in list(_open_attempts):
+                    if request_id not in pending_ids:
+                        del _open_attempts[request_id]
                 for req in requests_data:
                     request_id = req.get('id')
                     door_number = req.get('door_number')
-                    print(f"Processing door {door_number} request id {request_id}")
-                    if open_door(door_number):
-                        mark_request_executed(request_id)
+                    with event_context(request_id=request_id, door=door_number):
+                        log_event("door_request_received")
+                        if open_door(door_number):
+                            _open_attempts.pop(request_id, None)
+                            mark_request_executed(request_id)
+                        else:
+                            attempts = _open_attempts.get(request_id, 0) + 1
+                            _open_attempts[request_id] = attempts
+                            if attempts >= MAX_OPEN_ATTEMPTS:
+                                # Mark it anyway so a lost reply does not unlock the door every 5 seconds
+                                log_event("door_request_abandoned", level="error", attempts=attempts)
+                                _open_attempts.pop(request_id, None)
+                                mark_request_executed(request_id)
             else:
-                print(f"Error: {response.status_code} {response.text}")
+                log_event("door_requests_poll_failed", level="warning", status=response.status_code, response=response.text)
         except Exception as e:
-            print("Error polling door requests:", e)
+            log_event("door_requests_poll_failed", level="error", error=str(e))
         time.sleep(5)  # Poll every 5 seconds
 
 if __name__ == "__main__":
@@ -1,10 +1,11 @@
 import time
 import requests
 import sqlite3
-import serial
 import threading
 import subprocess
 import os
+import json
+import hashlib
 import cv2
 import numpy as np
 from datetime import datetime, timedelta
@@ -12,6 +13,8 @@ from pyzbar.pyzbar import decode
 from RPi import GPIO
 from RPLCD.i2c import CharLCD
 from constants import *  # Make sure DB_FILE, API_URL, API_KEY, OPEN_ALL_CODE, ALL_DOORS, etc. are defined here
+from door_controllers import open_doors
+from event_log import log_event, event_context, current_context, new_correlation_id, mask_code
 
 # ------------------------------------------------------------------------------
 # Constants
@@ -21,6 +24,8 @@ OFFLINE_SYNC_INTERVAL = 300   # 5 minutes for syncing offline actions
 ORDERS_SYNC_INTERVAL = 60     # Sync orders every 60 seconds
 LCD_TIMEOUT = 20              # Time before the LCD screen turns off without input
 MINUTES_TO_ACCEPT_ORDER_AFTER_PICKUP = 15  # Minutes to allow pickup after pickup time
+PREFETCH_MIN_INTERVAL = 10    # Seconds after a fetch during which a keypad prefetch is skipped
+ORDERS_FETCH_TIMEOUT = 10     # Seconds before an order fetch request (and the wait for it) is abandoned
 
 # Keypad Configuration
 KEYPAD = [
@@ -90,17 +95,114 @@ def initialize_database():
     conn.commit()
     conn.close()
 
+# ------------------------------------------------------------------------------
+# Database Snapshots (startup integrity check and local recovery)
+# ------------------------------------------------------------------------------
+DB_SNAPSHOT_FILE = DB_FILE + ".snapshot"  # Last known good copy, refreshed by the orders sync loop
+SNAPSHOT_MAX_AGE = 3600       # Refresh the snapshot at least hourly, to include offline actions
+
+def check_database_integrity(db_file):
+    """
+    Returns True if db_file is a readable SQLite database that passes PRAGMA integrity_check.
+    Uses a normal read-write connection, so SQLite first rolls back any hot journal left
+    by a power cut instead of reporting the database as unreadable.
+    """
+    if not os.path.exists(db_file):
+        return False
+    try:
+        conn = sqlite3.connect(db_file)
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()
+            conn.execute("SELECT COUNT(*) FROM orders").fetchone()
+        finally:
+            conn.close()
+        return result is not None and result[0] == "ok"
+    except sqlite3.DatabaseError:
+        return False
+
+def count_orders():
+    conn = sqlite3.connect(DB_FILE)
+    count = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    conn.close()
+    return count
+
+def _move_database(src, dst):
+    """Moves a database together with its journal files, so they stay paired for later recovery."""
+    os.replace(src, dst)
+    for suffix in ("-journal", "-wal", "-shm"):
+        if os.path.exists(src + suffix):
+            os.replace(src + suffix, dst + suffix)
+
+def save_local_snapshot():
+    """Copies the local database to DB_SNAPSHOT_FILE, if it passes a quick integrity check."""
+    tmp_file = DB_SNAPSHOT_FILE + ".tmp"
+    try:
+        src = sqlite3.connect(DB_FILE)
+        try:
+            if src.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+                log_event("snapshot_skipped_corrupt", level="error")
+                return False
+            dst = sqlite3.connect(tmp_file)
+            src.backup(dst)
+            dst.close()
+        finally:
+            src.close()
+        os.replace(tmp_file, DB_SNAPSHOT_FILE)
+        return True
+    except (sqlite3.DatabaseError, OSError) as e:
+        log_event("snapshot_save_failed", level="error", error=str(e))
+        return False
+
+def restore_local_snapshot():
+    """Restores DB_FILE from DB_SNAPSHOT_FILE. Returns True on success."""
+    if not check_database_integrity(DB_SNAPSHOT_FILE):
+        return False
+    tmp_file = DB_FILE + ".tmp"
+    src = sqlite3.connect(DB_SNAPSHOT_FILE)
+    dst = sqlite3.connect(tmp_file)
+    src.backup(dst)
+    dst.close()
+    src.close()
+    os.replace(tmp_file, DB_FILE)
+    log_event("database_restored", source="local_snapshot", orders=count_orders())
+    return True
+
+def bootstrap_database():
+    """
+    Makes sure DB_FILE is usable before the keypad starts, using only local files.
+    A database that fails PRAGMA integrity_check is moved aside (with its journals) to
+    DB_FILE.corrupt and replaced by the local snapshot. A missing or empty database, as on
+    a fresh or replaced SD card, is not bootstrapped here: it is filled by the first run of
+    the orders sync loop, which starts straight away without holding up the keypad.
+    """
+    if os.path.exists(DB_FILE) and not check_database_integrity(DB_FILE):
+        log_event("database_corrupt", level="error", db_file=DB_FILE)
+        _move_database(DB_FILE, DB_FILE + ".corrupt")
+        restore_local_snapshot()
+    initialize_database()
+
 # ------------------------------------------------------------------------------
 # Orders Sync Functions (runs in its own thread)
 # ------------------------------------------------------------------------------
 def fetch_orders():
-    """Fetch orders from the online API."""
+    """
+    Fetch orders from the online API. If the response carries an X-Orders-SHA256
+    header, the body is checked against it and discarded on mismatch.
+    """
     try:
-        response = requests.get(f"{API_URL}orders.php?api_key={API_KEY}")
+        response = requests.get(f"{API_URL}orders.php?api_key={API_KEY}", timeout=ORDERS_FETCH_TIMEOUT)
         response.raise_for_status()
-        return response.json()
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching orders: {e}")
+        log_event("orders_fetch_failed", level="error", error=str(e))
+        return []
+    expected = response.headers.get("X-Orders-SHA256", "").strip().lower()
+    if expected and expected != hashlib.sha256(response.content).hexdigest():
+        log_event("orders_checksum_mismatch", level="error", expected=expected)
+        return []
+    try:
+        return response.json()
+    except ValueError as e:
+        log_event("orders_fetch_failed", level="error", error=str(e))
         return []
 
 def sanitize_value(value):
@@ -151,19 +253,80 @@ def update_local_database(orders):
     conn.commit()
     conn.close()
 
+# Shared between the sync loop, keypad prefetch and the online fallback
+_orders_fetch_lock = threading.Lock()
+_orders_fetched_at = 0.0      # time.time() when the last successful fetch started
+_orders_digest = None         # Hash of the last fetched order set, used to detect changes
+_snapshot_digest = None       # _orders_digest at the time of the last local snapshot
+_snapshot_saved_at = 0.0
+_prefetch_lock = threading.Lock()
+_prefetch_thread = None
+
 def fetch_orders_now():
-    print("Fetching orders...")
-    orders = fetch_orders()
-    if orders:
-        update_local_database(orders)
-        print(f"Updated {len(orders)} orders.")
-    else:
-        print("No new orders found.")
+    global _orders_fetched_at, _orders_digest
+    with _orders_fetch_lock:
+        started = time.time()
+        log_event("orders_fetch_started", level="debug")
+        orders = fetch_orders()
+        if orders:
+            update_local_database(orders)
+            _orders_fetched_at = started
+            _orders_digest = hashlib.sha256(json.dumps(orders, sort_keys=True).encode()).hexdigest()
+            log_event("orders_fetched", count=len(orders), duration_ms=round((time.time() - started) * 1000))
+        else:
+            log_event("orders_fetch_empty", duration_ms=round((time.time() - started) * 1000))
+
+def prefetch_orders():
+    """
+    Starts a background order fetch when a keypad session begins, so new orders
+    are usually in the local database before the customer has finished typing.
+    Does nothing if a prefetch is already running or orders were fetched recently.
+    """
+    global _prefetch_thread
+    with _prefetch_lock:
+        if _prefetch_thread is not None and _prefetch_thread.is_alive():
+            return
+        if time.time() - _orders_fetched_at < PREFETCH_MIN_INTERVAL:
+            return
+        _prefetch_thread = threading.Thread(target=_fetch_orders_in_context, args=(current_context(),), daemon=True)
+        _prefetch_thread.start()
+
+def _fetch_orders_in_context(fields):
+    with event_context(**fields):
+        log_event("orders_prefetch")
+        fetch_orders_now()
+
+def refresh_orders_for_session(session_start):
+    """
+    Makes sure orders have been fetched for the keypad session started at session_start.
+    Waits for a running prefetch and only fetches again if no fetch started during the session.
+    """
+    with _prefetch_lock:
+        thread = _prefetch_thread
+    if thread is not None:
+        thread.join(ORDERS_FETCH_TIMEOUT)
+        if thread.is_alive():
+            log_event("orders_prefetch_timeout", level="warning")
+            return
+    if not session_start or _orders_fetched_at < session_start:
+        fetch_orders_now()
+
+def save_local_snapshot_if_changed():
+    """Saves a local snapshot when the order set changed, or when the last one is older than SNAPSHOT_MAX_AGE."""
+    global _snapshot_digest, _snapshot_saved_at
+    digest = _orders_digest
+    changed = digest is not None and digest != _snapshot_digest
+    if not changed and time.time() - _snapshot_saved_at < SNAPSHOT_MAX_AGE:
+        return
+    if save_local_snapshot():
+        _snapshot_digest = digest
+        _snapshot_saved_at = time.time()
 
 def orders_sync_loop():
-    """Loop that periodically syncs orders from the API."""
+    """Loop that periodically syncs orders from the API and keeps the local snapshot current."""
     while True:
         fetch_orders_now()
+        save_local_snapshot_if_changed()
         time.sleep(ORDERS_SYNC_INTERVAL)
 
 # ------------------------------------------------------------------------------
@@ -171,14 +334,14 @@ def orders_sync_loop():
 # ------------------------------------------------------------------------------
 def sync_offline_actions():
     """Attempts to sync offline actions with the API, including action_time."""
-    print("Checking offline pickups")
+    log_event("offline_sync_started", level="debug")
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     cursor.execute("SELECT id, order_id, action, action_time FROM offline_actions WHERE synced = 0")
     unsynced_actions = cursor.fetchall()
 
     for action_id, order_id, action, action_time in unsynced_actions:
-        if send_order_update(order_id, action, action_time, store_on_fail=False):
+        if send_order_update(order_id, action, action_time, store_on_fail=False, offline_action_id=action_id):
             cursor.execute("UPDATE offline_actions SET synced = 1 WHERE id = ?", (action_id,))
     
     conn.commit()
@@ -347,7 +510,7 @@ def fetch_door_items(order_id):
     conn.close()
     return doors
 
-def send_order_update(order_id, action, action_time=None, store_on_fail=True):
+def send_order_update(order_id, action, action_time=None, store_on_fail=True, offline_action_id=None):
     """
     Notifies the API that an order was picked up or opened, including action_time if provided.
     When store_on_fail is True, an unsynced action is inserted on failure.
@@ -359,10 +522,14 @@ def send_order_update(order_id, action, action_time=None, store_on_fail=True):
     try:
         response = requests.get(API_URL + "update_order_pickup.php", params=payload)
         if response.status_code == 200:
-            print(f"Successfully updated {action} for order {order_id}")
+            log_event("order_update_synced", order_id=order_id, action=action, action_time=action_time,
+                      offline_action_id=offline_action_id)
             return True
-    except requests.exceptions.RequestException:
-        print(f"Failed to sync {action} for order {order_id}.")
+        log_event("order_update_failed", level="warning", order_id=order_id, action=action,
+                  offline_action_id=offline_action_id, status=response.status_code)
+    except requests.exceptions.RequestException as e:
+        log_event("order_update_failed", level="warning", order_id=order_id, action=action,
+                  offline_action_id=offline_action_id, error=str(e))
 
     if store_on_fail:
         conn = sqlite3.connect(DB_FILE)
@@ -375,23 +542,14 @@ def send_order_update(order_id, action, action_time=None, store_on_fail=True):
                            (order_id, action))
         conn.commit()
         conn.close()
+        log_event("order_update_stored_offline", order_id=order_id, action=action)
     return False
 
 def open_relays(doors):
-    """Sends relay commands to Arduino to open specific doors in one batch."""
+    """Sends relay commands to open specific doors, one batch per controller (see door_controllers.py)."""
     if not doors:
         return
-    try:
-        ser = serial.Serial(SERIAL_PORT, 9600, timeout=1)
-        time.sleep(2)
-        relay_commands = [f"{door}:{i*500}:1000" for i, door in enumerate(doors)]
-        command = f"OPEN:{','.join(relay_commands)}\n"
-        ser.write(command.encode())
-        print(f"Sent command: {command.strip()}")
-        ser.readline()
-        ser.close()
-    except Exception as e:
-        print(f"Error opening relays: {e}")
+    open_doors(doors)
 
 def scan_qr_codes():
     """
@@ -428,7 +586,7 @@ def scan_qr_codes():
 
 def process_code(code):
     order_id, action = fetch_order_by_code(code)
-    print(f"Keypad code processed: {order_id}, {action}")
+    log_event("code_checked", code=mask_code(code), order_id=order_id, result=action)
     if order_id and action in ('pickup', 'opening'):
         lcd.clear()
         lcd.write_string("Accepted order:")
@@ -436,11 +594,13 @@ def process_code(code):
         lcd.write_string(f"{order_id}")
         time.sleep(2)
         doors = fetch_door_items(order_id)
+        log_event("order_accepted", order_id=order_id, action=action, doors=doors)
         lcd.clear()
         lcd.write_string(f"Opening door {','.join(doors)}")
-        open_relays(doors)
-        time.sleep(10)
-        send_order_update(order_id, action)
+        with event_context(order_id=order_id):
+            open_relays(doors)
+            time.sleep(10)
+            send_order_update(order_id, action)
         lcd.clear()
         return True
     elif order_id and action == 'already_picked_up':
@@ -466,7 +626,7 @@ def process_code(code):
 # ------------------------------------------------------------------------------
 def main():
     """Main function handling keypad scanning and starting background threads."""
-    initialize_database()
+    bootstrap_database()
 
     # Start background threads
     threading.Thread(target=orders_sync_loop, daemon=True).start()    # Sync orders from the API
@@ -475,6 +635,8 @@ def main():
 
     entered_code = ""
     last_input_time = None
+    session_start = 0.0
+    session_id = None
     lcd.clear()
     lcd.backlight_enabled = False
 
@@ -489,29 +651,38 @@ def main():
                         lcd.clear()
                         lcd.write_string("Enter Code:")
                         last_input_time = time.time()
+                        session_start = last_input_time
+                        session_id = new_correlation_id()
+                        with event_context(session=session_id):
+                            log_event("keypad_wake")
+                            prefetch_orders()  # Refresh orders while the code is being typed
                     else:
-                        print(f"Entered code: {entered_code}")
-                        if entered_code == OPEN_ALL_CODE:
-                            lcd.clear()
-                            lcd.write_string("Opening ALL doors")
-                            open_relays(ALL_DOORS)  # ALL_DOORS is a list of door identifiers
-                            time.sleep(10)
-                            lcd.clear()
-                        else:
-                            lcd.clear()
-                            lcd.write_string("Checking...")
-                            if not process_code(entered_code):
+                        with event_context(session=session_id or new_correlation_id()):
+                            if entered_code == OPEN_ALL_CODE:
+                                log_event("open_all_doors", level="warning")  # Never log the master code itself
+                                lcd.clear()
+                                lcd.write_string("Opening ALL doors")
+                                open_relays(ALL_DOORS)  # ALL_DOORS is a list of door identifiers
+                                time.sleep(10)
+                                lcd.clear()
+                            else:
+                                log_event("code_entered", code=mask_code(entered_code))  # Codes open doors, never log them in full
                                 lcd.clear()
-                                lcd.write_string("Checking online")
-                                fetch_orders_now()  # Update the database
+                                lcd.write_string("Checking...")
                                 if not process_code(entered_code):
                                     lcd.clear()
-                                    lcd.write_string("Invalid Code!")
-                                    time.sleep(3)
+                                    lcd.write_string("Checking online")
+                                    refresh_orders_for_session(session_start)  # Update the database
+                                    if not process_code(entered_code):
+                                        lcd.clear()
+                                        lcd.write_string("Invalid Code!")
+                                        time.sleep(3)
                         entered_code = ""
                         lcd.clear()
                         lcd.backlight_enabled = False
                         last_input_time = None
+                        session_start = 0.0
+                        session_id = None
                 elif key == '#':
                     entered_code = ""
                     lcd.clear()
@@ -529,9 +700,11 @@ def main():
                     lcd.backlight_enabled = False
                     entered_code = ""
                     last_input_time = None
+                    session_start = 0.0
+                    session_id = None
                 time.sleep(0.1)
     except KeyboardInterrupt:
-        print("Shutting down")
+        log_event("shutdown")
     finally:
         lcd.clear()
         lcd.backlight_enabled = False
@@ -298,8 +298,10 @@ function is_serialized($data) {
     return (@unserialize($data) !== false || $data === 'b:0;');
 }
 
-// Convert to JSON and output to the browser
-echo json_encode(array_values($orders), JSON_PRETTY_PRINT | JSON_UNESCAPED_UNICODE);
+// Convert to JSON and output to the browser, with a checksum the Raspberry Pi verifies before using the data
+$orders_json = json_encode(array_values($orders), JSON_PRETTY_PRINT | JSON_UNESCAPED_UNICODE);
+header("X-Orders-SHA256: " . hash('sha256', $orders_json));
+echo $orders_json;
 
 // Close the connection
 $conn->close();